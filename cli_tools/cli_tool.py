@@ -1,13 +1,23 @@
 """Debian Package Statistics Command Line Tool"""
 
 import argparse
+import io
+import mmap
+import json
 import os
 import re
 import gzip
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Dict, List, Set
+import heapq
+import shutil
+import sys
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import BinaryIO, Dict, Iterable, Iterator, List
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from exceptions.invalid_mirror_url_exception import InvalidMirrorURLException
 from exceptions.architecture_not_found_exception import ContentFilesForArchitectureNotFound
@@ -18,6 +28,18 @@ DEFAULT_DEBIAN_MIRROR_URL = "http://ftp.uk.debian.org/debian/dists/stable/main/"
 DEFAULT_COUNT = 10
 DEFAULT_OUTPUT_DIR = os.getcwd()
 DEFAULT_OVERRIDE_EXISTING = False
+READ_BUFFER_SIZE = 128 * 1024  # Copy in large chunks so big content files never sit fully in memory
+HTTP_CHUNK_SIZE = 1024 * 1024  # Read responses in large chunks to cut syscalls on big downloads
+MAX_DOWNLOAD_WORKERS = 8
+PARSED_CACHE_SUFFIX = ".counter.json"  # Appended to an extracted file's path to store its parsed counts
+
+# Matches content file names; the group is the architecture, i.e. the part after the last "-"
+_CONTENTS_RE = re.compile(r"Contents-(?:[a-z0-9-]+-)?([a-z0-9]+)\.gz", re.ASCII)
+
+# Shared session so all downloads from the mirror reuse kept-alive connections
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
 
 
 def get_content_files(mirror_url: str) -> Dict[str, List[List[str]]]:
@@ -34,21 +56,38 @@ def get_content_files(mirror_url: str) -> Dict[str, List[List[str]]]:
                             ]
                 }
     """
-    content_files = dict()
     try:
-        r = requests.get(mirror_url)
+        r = _SESSION.get(mirror_url)
     except requests.exceptions.MissingSchema:
         raise InvalidMirrorURLException()
         
-    html = r.text
+    return parse_listing(html=r.text, mirror_url=mirror_url)
+
+
+def parse_listing(html: str, mirror_url: str) -> Dict[str, List[List[str]]]:
+    """Returns a dictionary of architectures and a list of their 
+    associated content files found in the HTML listing of a debian mirror
+    
+    Args:
+        html: HTML directory listing of the debian mirror
+        mirror_url: URL of the debian mirror
+        
+    Returns:
+        Dict[str, List[List[str]]]
+        Example: {"amd64": [["file_name", "file_url"],
+                            ...
+                            ]
+                }
+    """
+    content_files = dict()
+    seen_files = set()  # A file name shows up in both the href and the text of its link
     
-    for line in html.split("\n"):
-        file_name = re.findall("Contents-[a-z,1-9,-]+\.gz", f"{line}")
-        if not file_name:
+    for match in _CONTENTS_RE.finditer(html):
+        file_name, architecture = match.group(0), match.group(1)
+        if file_name in seen_files:
             continue
-        file_name = file_name[0]
+        seen_files.add(file_name)
         file_url = mirror_url+file_name if mirror_url.endswith("/") else mirror_url+"/"+file_name
-        architecture = re.findall("(?<=\-)([a-z, 1-9]+)(?=\.)", file_name)[0]
         
         if architecture in content_files:
             content_files[architecture].append([file_name, file_url])
@@ -58,15 +97,41 @@ def get_content_files(mirror_url: str) -> Dict[str, List[List[str]]]:
     return content_files
 
 
+@contextmanager
+def _atomic_write(file_path: str) -> Iterator[BinaryIO]:
+    """Open a temporary file next to file_path for writing, and move it onto
+    file_path only once the block finishes without errors, so that a failed
+    write never leaves a partial file behind
+    
+    Arguments:
+        file_path: path of the file to write
+    Returns:
+        Iterator[BinaryIO]: the temporary file opened in binary mode
+    """
+    # Unlike tempfile.mkstemp, which always uses mode 0600, this lets the umask decide the
+    # permissions, so the file ends up with the same mode as one created with open()
+    tmp_file = f"{file_path}.{uuid.uuid4().hex}.tmp"
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with open(fd, "wb") as file_buffer:
+            yield file_buffer
+        os.replace(tmp_file, file_path)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
 def download_content_file(
         file_url: str, output_dir: str,
-        override_existing: bool) -> str:
+        override_existing: bool, keep_gz: bool = False) -> str:
     """Download content_file from file_url into output_dir
     
     Arguments:
         file_url: URL of content file
         output_dir: Folder for downloaded file. Default is the current working directory
         override_existing: Whether or not to use already downloaded content_file
+        keep_gz: Whether or not to also keep the downloaded gz file. When False, the
+            file is decompressed while it is downloaded and only the extracted file is written
     Returns:
         str: path of the content index file that was extracted from the downloaded file
     """
@@ -79,47 +144,118 @@ def download_content_file(
     gz_file = os.path.join(output_dir, base_name)
     extracted_file = os.path.join(output_dir, file_name)
     
-    if file_name in os.listdir(output_dir) and (not override_existing):
+    if not override_existing and os.path.exists(extracted_file):
+        return extracted_file
+    
+    if not keep_gz:
+        # Extract file straight from the download, without writing the gz file to disk
+        with _SESSION.get(file_url, stream=True) as rq:
+            rq.raise_for_status()
+            rq.raw.auto_close = False  # Let the buffered reader see EOF instead of a closed stream
+            with gzip.GzipFile(fileobj=io.BufferedReader(rq.raw, buffer_size=HTTP_CHUNK_SIZE)) as gz_buffer, \
+                    _atomic_write(extracted_file) as file_buffer:
+                shutil.copyfileobj(gz_buffer, file_buffer, length=READ_BUFFER_SIZE)
         return extracted_file
     
     # Download content file from file_url
-    with requests.get(file_url) as rq, open(gz_file, "wb") as file_buffer:
-        file_buffer.write(rq.content)
+    with _SESSION.get(file_url, stream=True) as rq:
+        rq.raise_for_status()
+        with _atomic_write(gz_file) as file_buffer:
+            shutil.copyfileobj(rq.raw, file_buffer, length=HTTP_CHUNK_SIZE)
     
     # Extract file from downloaded gz file
-    with gzip.open(gz_file) as gz_buffer, open(extracted_file, "wb") as file_buffer:
-        file_buffer.write(gz_buffer.read())
+    try:
+        with gzip.open(gz_file, "rb") as gz_buffer, _atomic_write(extracted_file) as file_buffer:
+            shutil.copyfileobj(gz_buffer, file_buffer, length=READ_BUFFER_SIZE)
+    except BaseException:
+        os.remove(gz_file)  # Do not keep a gz file that cannot be extracted
+        raise
         
     return extracted_file
 
 
-def parse_contents_index(extracted_file: str) -> Dict[str, Set[str]]:
-    """Parse contents index file and returns dictionary with the package
-    names and a set of their associated files
+def parse_lines(lines: Iterable[bytes]) -> Counter:
+    """Parse the lines of a contents index and returns a counter with the
+    package names and the number of their associated files
+    
+    Arguments:
+        lines: any iterable of contents index lines in bytes, e.g. a file opened in binary mode
+    Returns:
+        Counter
+        Example: {"package_name": 3}
+    """
+    packages_count = Counter()
+    for line in lines:
+        # File names never end with a space, so the last space separates them from the packages
+        file_name, _, packages = line.rstrip().rpartition(b" ")
+        if not file_name or file_name.rstrip() == b"EMPTY_PACKAGE":
+            continue
+        for package in packages.split(b","):
+            packages_count[package] += 1
+    
+    # Only decode (and intern) the package names once each, instead of on every line
+    return Counter({sys.intern(package.decode()): num_files for package, num_files in packages_count.items()})
+
+
+def parse_contents_index(extracted_file: str) -> Counter:
+    """Parse contents index file and returns a counter with the package
+    names and the number of their associated files. The result is cached
+    next to extracted_file and reused for as long as the file is unchanged
     
     Arguments:
         extracted_file: path of the file extracted from the downloaded gz file
     Returns:
-        Dict[str, Set[str]]
-        Example: {"package_name": (fileA, fileB, ...)}
+        Counter
+        Example: {"package_name": 3}
     """
-    with open(extracted_file, "r") as file_buffer:
-        packages_dict = dict()
-        for line in file_buffer:
-            line = line.strip()
-            parsed_line = " ".join(line.split()).split(" ")  # Remove large space between files and packages and split the two
-            file_name, packages = parsed_line[0], parsed_line[-1]
-            for package in packages.split(","):
-                if file_name == "EMPTY_PACKAGE":
-                    break
-                if package in packages_dict:
-                    packages_dict[package].add(file_name)
-                else:
-                    packages_dict[package] = {file_name}
-        
-    return packages_dict
-                
-                
+    cache_file = extracted_file + PARSED_CACHE_SUFFIX
+    file_stat = os.stat(extracted_file)
+    cache_key = (file_stat.st_mtime_ns, file_stat.st_size)
+    
+    try:
+        with open(cache_file, "r", encoding="utf-8") as file_buffer:
+            cached_key, cached_count = json.load(file_buffer)
+        if (cached_key == list(cache_key) and isinstance(cached_count, dict)
+                and all(type(num_files) is int for num_files in cached_count.values())):
+            return Counter({sys.intern(package): num_files for package, num_files in cached_count.items()})
+    except (OSError, ValueError, TypeError):
+        pass  # Missing or unreadable cache, parse the file again and overwrite it
+    
+    if file_stat.st_size == 0:
+        packages_count = Counter()  # An empty file cannot be memory mapped
+    else:
+        # Map the file so lines are read straight from the page cache, without copying through a read buffer
+        with open(extracted_file, "rb") as file_buffer, \
+                mmap.mmap(file_buffer.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            packages_count = parse_lines(iter(mapped_file.readline, b""))
+    
+    try:
+        with _atomic_write(cache_file) as file_buffer:
+            file_buffer.write(json.dumps([list(cache_key), packages_count]).encode("utf-8"))
+    except OSError:
+        pass  # The cache is best effort, e.g. output_dir may be read-only
+    
+    return packages_count
+
+
+def merge_package_counts(packages_counts: Iterable[Counter]) -> Counter:
+    """Merge the package counts of several content files into one counter
+    
+    Arguments:
+        packages_counts: counters returned by parse_contents_index
+    Returns:
+        Counter
+        Example: {"package_name": 3}
+    """
+    merged_count = Counter()
+    for packages_count in packages_counts:
+        # Counter.update adds up the counts of packages found in several content files
+        # rather than overwriting them like dict.update would
+        merged_count.update(packages_count)
+    
+    return merged_count
+
+
 def main(
         mirror_url: str, architecture: str, override_existing: bool, 
         output_dir: str, count: int) -> None:
@@ -141,29 +277,31 @@ def main(
     if count < 0:
         raise InvalidCountException("count cannot be a negative integer")
     
-    packages_dict = dict()
+    files = content_files[architecture]
+    download_workers = min(len(files), MAX_DOWNLOAD_WORKERS)  # No idle threads when there are only a few files
+    parse_workers = min(len(files), os.cpu_count() or 1)  # No idle processes either
     
-    with ThreadPoolExecutor() as executor:
-        # Use threading to improve performace. It is most efficient when there are numerous downloads.
-        results = [executor.submit(download_content_file, file_info[1], output_dir, override_existing)  # file_info[1] is file_url
-                   for file_info in content_files[architecture]]
+    # Downloads are I/O bound and run in threads, while parsing is CPU bound and runs in
+    # separate processes so that content files are parsed in parallel, outside the GIL.
+    with ThreadPoolExecutor(max_workers=download_workers) as download_executor, \
+            ProcessPoolExecutor(max_workers=parse_workers) as parse_executor:
+        downloads = [download_executor.submit(download_content_file, file_url, output_dir, override_existing)
+                     for _, file_url in files]
         
-        for f in as_completed(results):
-            packages_dict.update(parse_contents_index(f.result()))
+        # Each file is handed to a parser as soon as its download finishes
+        parses = [parse_executor.submit(parse_contents_index, f.result())
+                  for f in as_completed(downloads)]
+        
+        packages_count = merge_package_counts(f.result() for f in as_completed(parses))
             
-    packages_file_count = {key: len(val) for key, val in sorted(packages_dict.items(), key = lambda ele: len(ele[1]), reverse=True)}
+    # Only the top count packages are printed, so there is no need to sort all of them
+    top_packages = heapq.nlargest(count, packages_count.items(), key = lambda ele: ele[1])
     
     print("\n","No.", " "*5, "Package", " "*45, "Number of Files")
     
-    i = 1  # Counter to number the packages
-    for package in packages_file_count:
-        if count > 0:
-            dist = 60-len(package)  # Spacing between package name and number of files
-            print("", f"{i}", " "*5, f"{package}", " "*dist, f"{packages_file_count[package]}")
-            count -= 1
-            i += 1
-        else:
-            break  # End for loop after the print limit is reached 
+    for i, (package, num_files) in enumerate(top_packages, start=1):  # i numbers the packages
+        dist = 60-len(package)  # Spacing between package name and number of files
+        print("", i, " "*5, package, " "*dist, num_files)
         
     return None    
 
@@ -202,7 +340,10 @@ def cli_func() -> None:
         "-o",
         "--output_dir",
         type=str,
-        help="Path to folder where downloaded and extracted files should be kept."
+        help=(
+            "Path to folder where downloaded and extracted files should be kept."
+            " Parsed package counts are cached there too, in <file>.counter.json files."
+        )
     )
     
     parser.add_argument(
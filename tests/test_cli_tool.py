@@ -2,13 +2,24 @@
 
 import sys
 sys.path.append("cli_tools")  # Add cli_tool to add that test_cli_tool.py can access exceptions
+import functools
+import gzip
+import json
 import os
+import tempfile
+import threading
 import unittest
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
 
 from cli_tool import (
     get_content_files,
+    parse_listing,
     download_content_file,
+    parse_lines,
     parse_contents_index,
+    merge_package_counts,
     main,
 )
 from exceptions.architecture_not_found_exception import (
@@ -91,6 +102,167 @@ class CLITest(unittest.TestCase):
                 output_dir=self.args["output_dir"],
             )    
         )
+
+
+class ParseListingTest(unittest.TestCase):
+    def test_parse_listing(self):
+        html = (
+            '<a href="Contents-amd64.gz">Contents-amd64.gz</a>  2022-07-09 10:00  10M\n'
+            '<a href="Contents-s390x.gz">Contents-s390x.gz</a>  2022-07-09 10:00  10M\n'
+            '<a href="Contents-udeb-amd64.gz">Contents-udeb-amd64.gz</a>  2022-07-09 10:00  1M\n'
+            '<a href="Release">Release</a>  2022-07-09 10:00  1K\n'
+        )
+        self.assertEqual(parse_listing(html=html, mirror_url="http://mirror/main"), {
+            "amd64": [["Contents-amd64.gz", "http://mirror/main/Contents-amd64.gz"],
+                      ["Contents-udeb-amd64.gz", "http://mirror/main/Contents-udeb-amd64.gz"]],
+            "s390x": [["Contents-s390x.gz", "http://mirror/main/Contents-s390x.gz"]],
+        })
+
+
+class ParseLinesTest(unittest.TestCase):
+    def test_parse_lines(self):
+        lines = [
+            b"usr/bin/foo                    utils/foo\n",
+            b"usr/share/doc/foo/README       utils/foo,doc/foo-doc\n",
+            b"EMPTY_PACKAGE                  utils/bar\n",
+        ]
+        self.assertEqual(parse_lines(lines), {"utils/foo": 2, "doc/foo-doc": 1})
+    
+    def test_parse_lines_with_spaces_in_file_name(self):
+        lines = [
+            b"usr/share/doc/foo/Read Me      utils/foo\n",
+            b"usr/share/doc/foo/My Notes.txt doc/foo-doc,utils/foo\n",
+        ]
+        self.assertEqual(parse_lines(lines), {"utils/foo": 2, "doc/foo-doc": 1})
+    
+    def test_parse_lines_skips_lines_without_separator(self):
+        lines = [
+            b"utils/foo\n",
+            b"\n",
+            b"usr/bin/foo                    utils/foo\n",
+        ]
+        self.assertEqual(parse_lines(lines), {"utils/foo": 1})
+
+
+class ParseContentsIndexCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.extracted_file = os.path.join(self.tmp_dir.name, "Contents-armel")
+        with open(self.extracted_file, "w") as file_buffer:
+            file_buffer.write("usr/bin/foo                    utils/foo\n")
+    
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+    
+    def test_parsed_counts_are_cached(self):
+        cache_file = self.extracted_file + ".counter.json"
+        self.assertEqual(parse_contents_index(self.extracted_file), {"utils/foo": 1})
+        self.assertTrue(os.path.isfile(cache_file))
+        
+        # Change the cached counts under the same key, so only a cache hit can return them
+        with open(cache_file) as file_buffer:
+            cache_key, _ = json.load(file_buffer)
+        with open(cache_file, "w") as file_buffer:
+            json.dump([cache_key, {"utils/cached": 7}], file_buffer)
+        self.assertEqual(parse_contents_index(self.extracted_file), {"utils/cached": 7})
+    
+    def test_invalid_cache_is_ignored(self):
+        for cache_content in ("not json", "42", '[[0, 0], {"utils/foo": 1}, 3]', '[null, ["utils/foo"]]'):
+            with open(self.extracted_file + ".counter.json", "w") as file_buffer:
+                file_buffer.write(cache_content)
+            self.assertEqual(parse_contents_index(self.extracted_file), {"utils/foo": 1})
+    
+    def test_unwritable_cache_is_skipped(self):
+        os.mkdir(self.extracted_file + ".counter.json")  # Neither readable nor replaceable as a file
+        self.assertEqual(parse_contents_index(self.extracted_file), {"utils/foo": 1})
+        self.assertEqual([name for name in os.listdir(self.tmp_dir.name) if name.endswith(".tmp")], [])
+    
+    def test_cache_is_refreshed_when_file_changes(self):
+        parse_contents_index(self.extracted_file)
+        with open(self.extracted_file, "a") as file_buffer:
+            file_buffer.write("usr/bin/bar                    utils/bar\n")
+        self.assertEqual(parse_contents_index(self.extracted_file),
+                         {"utils/foo": 1, "utils/bar": 1})
+
+
+class MergePackageCountsTest(unittest.TestCase):
+    def test_counts_of_content_files_add_up(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            deb_file = os.path.join(tmp_dir, "Contents-amd64")
+            udeb_file = os.path.join(tmp_dir, "Contents-udeb-amd64")
+            with open(deb_file, "w") as file_buffer:
+                file_buffer.write("usr/bin/foo                    utils/foo\n"
+                                  "usr/bin/bar                    utils/bar\n")
+            with open(udeb_file, "w") as file_buffer:
+                file_buffer.write("lib/foo.so                     utils/foo\n")
+            
+            merged_count = merge_package_counts(
+                [parse_contents_index(deb_file), parse_contents_index(udeb_file)])
+        
+        self.assertEqual(merged_count, {"utils/foo": 2, "utils/bar": 1})
+
+
+class QuietHTTPRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class DownloadContentFileTest(unittest.TestCase):
+    def setUp(self):
+        self.mirror_dir = tempfile.TemporaryDirectory()
+        self.output_dir = tempfile.TemporaryDirectory()
+        content = b"usr/bin/foo                    utils/foo\n" * 1000
+        with gzip.open(os.path.join(self.mirror_dir.name, "Contents-armel.gz"), "wb") as file_buffer:
+            file_buffer.write(content)
+        with open(os.path.join(self.mirror_dir.name, "Contents-armel.gz"), "rb") as file_buffer:
+            compressed = file_buffer.read()
+        with open(os.path.join(self.mirror_dir.name, "Contents-truncated.gz"), "wb") as file_buffer:
+            file_buffer.write(compressed[:len(compressed) // 2])
+        
+        handler = functools.partial(QuietHTTPRequestHandler, directory=self.mirror_dir.name)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.mirror_url = f"http://127.0.0.1:{self.server.server_port}/"
+    
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.mirror_dir.cleanup()
+        self.output_dir.cleanup()
+    
+    def test_download_content_file(self):
+        for keep_gz in (False, True):
+            extracted_file = download_content_file(
+                file_url=self.mirror_url + "Contents-armel.gz",
+                output_dir=self.output_dir.name,
+                override_existing=True,
+                keep_gz=keep_gz)
+            self.assertEqual(parse_contents_index(extracted_file), {"utils/foo": 1000})
+    
+    def test_downloaded_file_mode_follows_umask(self):
+        umask = os.umask(0)
+        os.umask(umask)
+        extracted_file = download_content_file(
+            file_url=self.mirror_url + "Contents-armel.gz",
+            output_dir=self.output_dir.name,
+            override_existing=True)
+        self.assertEqual(os.stat(extracted_file).st_mode & 0o777, 0o666 & ~umask)
+    
+    def test_failed_download_leaves_no_file(self):
+        for keep_gz in (False, True):
+            with self.assertRaises(requests.HTTPError):
+                download_content_file(
+                    file_url=self.mirror_url + "Contents-missing.gz",
+                    output_dir=self.output_dir.name,
+                    override_existing=False,
+                    keep_gz=keep_gz)
+            with self.assertRaises(EOFError):
+                download_content_file(
+                    file_url=self.mirror_url + "Contents-truncated.gz",
+                    output_dir=self.output_dir.name,
+                    override_existing=False,
+                    keep_gz=keep_gz)
+        self.assertEqual(os.listdir(self.output_dir.name), [])
             
             
 if __name__ == '__main__':